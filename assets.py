@@ -0,0 +1,143 @@
+"""
+Assets
+In-memory, precompressed static asset cache for HiveAggregator
+
+Files with a web asset extension under each mount's allowlisted paths are
+read once at startup; anything else (docs, tests, build files) is not
+served. Text-like assets are kept alongside gzip (and brotli, when the
+brotli module is installed) variants, and each variant carries a strong ETag
+derived from the content hash and its encoding. Requests are answered from memory with Cache-Control/ETag headers, the
+smallest encoding the client accepts, and 304 Not Modified when the client
+already holds the current version.
+"""
+
+# Libraries
+import hashlib
+import mimetypes
+import os
+import zlib
+import cherrypy
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Constants
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/x-javascript', 'application/json', 'image/svg+xml', 'application/vnd.ms-fontobject', 'font/ttf', 'application/x-font-ttf')
+MIN_COMPRESS_SIZE = 256
+EXTENSIONS = ('.html', '.css', '.js', '.map', '.ico', '.png', '.gif', '.jpg', '.svg', '.eot', '.ttf', '.woff', '.woff2')
+BROTLI_QUALITY = 5 # startup cost grows steeply above this for little gain
+STATIC2_INCLUDE = ['index.html', 'index.css', 'front_end_scripts.js', 'd3.js', 'd3.min.js', 'jquery-1.11.2.min.js', 'bootstrap-3.3.4-dist', 'bootstrap-datepicker-master/dist', 'c3-0.4.10/c3.css', 'c3-0.4.10/c3.min.css', 'c3-0.4.10/c3.js', 'c3-0.4.10/c3.min.js'] # the built files Static2/index.html uses, not the vendored sources
+
+## Gzip-compress bytes (zlib with a gzip header works on Python 2 and 3)
+def gzip_bytes(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+## Encodings accepted by the client, from an Accept-Encoding header
+def accepted_encodings(header):
+    accepted = set()
+    for token in (header or '').split(','):
+        parts = [p.strip() for p in token.split(';')]
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if parts[0] and quality > 0:
+            accepted.add(parts[0].lower())
+    return accepted
+
+class Asset:
+    def __init__(self, path, data):
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        digest = hashlib.sha1(data).hexdigest()[:20]
+        self.variants = {'identity' : data}
+        if len(data) >= MIN_COMPRESS_SIZE and self.content_type.startswith(COMPRESSIBLE):
+            compressed = gzip_bytes(data)
+            if len(compressed) < len(data):
+                self.variants['gzip'] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=BROTLI_QUALITY)
+                if len(compressed) < len(data):
+                    self.variants['br'] = compressed
+        self.etags = dict((encoding, '"%s"' % digest if encoding == 'identity' else '"%s-%s"' % (digest, encoding)) for encoding in self.variants)
+
+    ## Smallest variant the client accepts
+    def select(self, accept_encoding):
+        accepted = accepted_encodings(accept_encoding)
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and (encoding in accepted or '*' in accepted):
+                return encoding, self.variants[encoding]
+        return 'identity', self.variants['identity']
+
+class AssetCache:
+    def __init__(self, mounts, max_age=3600):
+        """
+        mounts is a list of (url_prefix, directory, include) triples, where
+        include lists the files and subdirectories (relative to directory) to
+        serve, or is None for the whole directory, e.g.
+        [('/', 'static', None), ('/Static2', 'Static2', ['index.html', 'c3-0.4.10/c3.js'])]
+        """
+        self.max_age = max_age
+        self.assets = {}
+        for prefix, directory, include in mounts:
+            self.load(prefix, directory, include)
+
+    ## Load the allowlisted asset files of a directory under a URL prefix
+    def load(self, prefix, directory, include=None):
+        for entry in (include or ['']):
+            top = os.path.join(directory, entry)
+            if os.path.isfile(top):
+                walk = [(os.path.dirname(top), [], [os.path.basename(top)])]
+            else:
+                walk = os.walk(top)
+            for root, dirs, files in walk:
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                for name in files:
+                    if name.startswith('.') or not name.lower().endswith(EXTENSIONS):
+                        continue
+                    path = os.path.join(root, name)
+                    url = '/'.join([prefix.rstrip('/')] + os.path.relpath(path, directory).split(os.sep))
+                    with open(path, 'rb') as asset_file:
+                        self.assets[url] = Asset(path, asset_file.read())
+
+    ## Total bytes held in memory
+    def size(self):
+        return sum(len(v) for asset in self.assets.values() for v in asset.variants.values())
+
+    ## Answer the current request from the cache, returns None if not cached
+    def respond(self, path):
+        if path.endswith('/'):
+            path += 'index.html'
+        asset = self.assets.get(path)
+        if asset is None:
+            return None
+        request = cherrypy.request
+        response = cherrypy.response
+        encoding, data = asset.select(request.headers.get('Accept-Encoding'))
+        response.headers['ETag'] = asset.etags[encoding]
+        response.headers['Cache-Control'] = 'public, max-age=%d' % self.max_age
+        response.headers['Vary'] = 'Accept-Encoding'
+        if_none_match = [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]
+        if_none_match = [tag[2:] if tag.startswith('W/') else tag for tag in if_none_match] # weak comparison, RFC 7232 3.2
+        if asset.etags[encoding] in if_none_match or '*' in if_none_match:
+            response.status = 304
+            return b''
+        response.headers['Content-Type'] = asset.content_type
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        return data
+
+    ## CherryPy 'before_handler' hook, see cherrypy.Tool
+    def tool(self):
+        request = cherrypy.request
+        if request.method not in ('GET', 'HEAD'):
+            return
+        body = self.respond(request.path_info)
+        if body is not None:
+            cherrypy.response.body = body
+            request.handler = None
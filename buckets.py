@@ -0,0 +1,105 @@
+"""
+Buckets
+Time-bucketed sample layout for HiveAggregator
+
+Instead of one document per reading, the bucketed layout keeps one document
+per hive per time bucket (an hour by default) in the same per-day database
+and per-hive collection used by store_sample(). Each parameter is stored as
+an array parallel to the 'time' array, e.g.
+
+    {
+        'type' : 'bucket',
+        'hive_id' : 'hive1',
+        'start' : datetime(2015, 6, 1, 14),
+        'count' : 2,
+        'time' : [datetime(2015, 6, 1, 14, 0, 3), datetime(2015, 6, 1, 14, 0, 9)],
+        'int_t' : [33.1, 33.0],
+        'ext_t' : [21.4, None],
+        ...
+    }
+
+Readings missing a parameter push None so the arrays stay aligned.
+"""
+
+# Libraries
+from datetime import datetime, timedelta
+
+# Constants
+BUCKET_TYPE = 'bucket'
+SAMPLE_TYPE = 'sample'
+INDEX = [('type', 1), ('start', 1)] # serves the bucket upsert and range lookups
+EPOCH = datetime(1970, 1, 1)
+
+## Start of the bucket containing a time
+def bucket_start(time, bucket_seconds):
+    offset = int((time - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=offset - offset % bucket_seconds)
+
+## Upsert spec and document for appending one sample to its bucket
+def bucket_update(sample, parameters, bucket_seconds):
+    start = bucket_start(sample['time'], bucket_seconds)
+    spec = {
+        'type' : BUCKET_TYPE,
+        'hive_id' : sample['hive_id'],
+        'start' : start,
+        }
+    push = {'time' : sample['time']}
+    for key in parameters:
+        if key != 'time':
+            push[key] = sample.get(key)
+    document = {
+        '$push' : push,
+        '$inc' : {'count' : 1},
+        }
+    return spec, document
+
+## Upsert spec and document for appending many samples of one bucket
+def bucket_update_many(samples, parameters, bucket_seconds):
+    samples = sorted(samples, key=lambda s: s['time'])
+    spec, document = bucket_update(samples[0], parameters, bucket_seconds)
+    document['$push'] = dict((key, {'$each' : [s.get(key) for s in samples]}) for key in document['$push'])
+    document['$inc'] = {'count' : len(samples)}
+    return spec, document
+
+## Group samples by (hive_id, bucket start)
+def group_samples(samples, bucket_seconds):
+    groups = {}
+    for sample in samples:
+        key = (sample['hive_id'], bucket_start(sample['time'], bucket_seconds))
+        groups.setdefault(key, []).append(sample)
+    return groups
+
+## Find spec selecting the buckets which may overlap [start, end]
+def bucket_spec(start, end, bucket_seconds):
+    return {
+        'type' : BUCKET_TYPE,
+        'start' : {'$gt' : start - timedelta(seconds=bucket_seconds), '$lte' : end},
+        }
+
+## Unpack a bucket into per-reading samples
+def unpack_bucket(bucket, start=None, end=None, fields=None):
+    """
+    Yields one sample dict per reading in the bucket, restricted to readings
+    within [start, end] and to the given fields (all arrays if None).
+    """
+    times = bucket['time']
+    if fields is None:
+        fields = [key for key, value in bucket.items() if key != 'time' and isinstance(value, list)]
+    columns = [(key, bucket[key]) for key in fields if key != 'time' and key in bucket]
+    for i, time in enumerate(times):
+        if (start and time < start) or (end and time > end):
+            continue
+        sample = {
+            'type' : SAMPLE_TYPE,
+            'hive_id' : bucket['hive_id'],
+            'time' : time,
+            }
+        for key, values in columns:
+            sample[key] = values[i]
+        yield sample
+
+## Unpack every bucket of a cursor
+def unpack_buckets(cursor, start=None, end=None, fields=None):
+    for bucket in cursor:
+        for sample in unpack_bucket(bucket, start, end, fields):
+            yield sample
@@ -0,0 +1,131 @@
+"""
+Catalog
+Partition catalog for the "%Y%m%d" day-databases
+
+One document per (day-database, hive collection) records the first and last
+sample time, the sample count and the parameters seen, e.g.
+
+    {
+        '_id' : '20150601/hive1',
+        'db' : '20150601',
+        'hive_id' : 'hive1',
+        'min_time' : datetime(2015, 6, 1, 0, 0, 4),
+        'max_time' : datetime(2015, 6, 1, 23, 59, 58),
+        'count' : 17280,
+        'parameters' : ['int_t', 'ext_t', ...],
+    }
+
+It is updated on ingest so queries can skip partitions that cannot match
+without opening or listing every day-database. Days with no catalog entry at
+all (data stored before the catalog existed, or not yet rebuilt) fall back to
+listing their collections, so they are never silently skipped.
+"""
+
+# Libraries
+from datetime import datetime
+
+# Constants
+COLLECTION = 'partitions'
+REBUILD_COLLECTION = 'partitions_rebuild'
+
+## Catalog key of a partition
+def partition_id(db_name, hive_id):
+    return '%s/%s' % (db_name, hive_id)
+
+## Record one sample stored at ingest (samples arrive in time order)
+def record(mongo_client, catalog_db, db_name, sample, parameters):
+    spec = {'_id' : partition_id(db_name, sample['hive_id'])}
+    document = {
+        '$setOnInsert' : {'db' : db_name, 'hive_id' : sample['hive_id'], 'min_time' : sample['time']},
+        '$set' : {'max_time' : sample['time']},
+        '$inc' : {'count' : 1},
+        '$addToSet' : {'parameters' : {'$each' : [key for key in parameters if key != 'time' and key in sample]}},
+        }
+    mongo_client[catalog_db][COLLECTION].update(spec, document, upsert=True)
+
+## Record a batch of samples for one partition, in any time order
+def record_many(mongo_client, catalog_db, db_name, hive_id, times, count, present, collection_name=COLLECTION):
+    collection = mongo_client[catalog_db][collection_name]
+    spec = {'_id' : partition_id(db_name, hive_id)}
+    entry = collection.find_one(spec) or {}
+    min_time = min([t for t in (entry.get('min_time'), min(times)) if t is not None])
+    max_time = max([t for t in (entry.get('max_time'), max(times)) if t is not None])
+    document = {
+        '$set' : {'db' : db_name, 'hive_id' : hive_id, 'min_time' : min_time, 'max_time' : max_time},
+        '$inc' : {'count' : count},
+        '$addToSet' : {'parameters' : {'$each' : [key for key in present if key != 'time']}},
+        }
+    collection.update(spec, document, upsert=True)
+
+## Partitions of the given day-databases which may hold matching samples
+def partitions(mongo_client, catalog_db, db_names, start=None, end=None, hives=None, parameters=None):
+    db_names = sorted(set(db_names)) # a MONGO_DB without date directives maps every day to one database
+    collection = mongo_client[catalog_db][COLLECTION]
+    spec = {'db' : {'$in' : db_names}}
+    if start is not None:
+        spec['max_time'] = {'$gte' : start}
+    if end is not None:
+        spec['min_time'] = {'$lte' : end}
+    if hives is not None:
+        spec['hive_id'] = {'$in' : list(hives)}
+    if parameters is not None:
+        spec['parameters'] = {'$in' : list(parameters)}
+    result = list(collection.find(spec))
+    catalogued = set(collection.find({'db' : {'$in' : db_names}}).distinct('db'))
+    missing = [db_name for db_name in db_names if db_name not in catalogued]
+    if missing: # uncatalogued days are listed directly
+        existing = set(mongo_client.database_names())
+        for db_name in missing:
+            if db_name not in existing:
+                continue
+            for name in mongo_client[db_name].collection_names():
+                if name.startswith('system.') or (hives is not None and name not in hives):
+                    continue
+                result.append({'db' : db_name, 'hive_id' : name})
+    return sorted(result, key=lambda entry: (entry['db'], entry['hive_id']))
+
+## Hives and their date coverage
+def coverage(mongo_client, catalog_db):
+    result = {}
+    for entry in mongo_client[catalog_db][COLLECTION].find():
+        hive = result.setdefault(entry['hive_id'], {'first' : entry['min_time'], 'last' : entry['max_time'], 'count' : 0, 'days' : []})
+        hive['first'] = min(hive['first'], entry['min_time'])
+        hive['last'] = max(hive['last'], entry['max_time'])
+        hive['count'] += entry['count']
+        hive['days'].append(entry['db'])
+    for hive in result.values():
+        hive['days'].sort()
+    return result
+
+## Rebuild the catalog by scanning every day-database
+def rebuild(mongo_client, catalog_db, db_format, parameters, bucket_type='bucket'):
+    """
+    Builds into a temporary collection which replaces the catalog once the
+    scan completes, so queries keep using the old catalog meanwhile. Stop the
+    aggregator first: samples ingested into a partition after it was scanned
+    are recorded only in the old catalog, which the rename discards.
+    """
+    mongo_client[catalog_db][REBUILD_COLLECTION].drop()
+    for db_name in sorted(mongo_client.database_names()):
+        try:
+            datetime.strptime(db_name, db_format)
+        except ValueError:
+            continue
+        mongo_db = mongo_client[db_name]
+        for name in mongo_db.collection_names():
+            if name == 'system.indexes':
+                continue
+            times = []
+            present = set()
+            for document in mongo_db[name].find():
+                if document.get('type') == bucket_type:
+                    times.extend(document['time'])
+                    present.update(key for key in parameters if any(v is not None for v in document.get(key) or []))
+                elif 'time' in document:
+                    times.append(document['time'])
+                    present.update(key for key in parameters if document.get(key) is not None)
+            if times:
+                record_many(mongo_client, catalog_db, db_name, name, times, len(times), present, REBUILD_COLLECTION)
+                yield db_name, name, len(times)
+    if REBUILD_COLLECTION in mongo_client[catalog_db].collection_names():
+        mongo_client[catalog_db][REBUILD_COLLECTION].rename(COLLECTION, dropTarget=True)
@@ -0,0 +1,61 @@
+"""
+Coalesce
+Single-flight request coalescing for the query layer
+
+Concurrent callers asking for the same key share one in-flight call: the
+first caller runs the function, the rest wait for it and receive the same
+result (or exception). Nothing is cached once the call completes.
+"""
+
+# Libraries
+import threading
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.executed = 0 # calls actually run
+        self.coalesced = 0 # callers which waited on another caller's call
+        self.max_waiters = 0 # most callers sharing a single call
+
+    ## Run function() once per key among concurrent callers
+    def do(self, key, function, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                self.max_waiters = max(self.max_waiters, call.waiters)
+                leader = False
+            else:
+                call = self.calls[key] = Call()
+                self.executed += 1
+                leader = True
+        if leader:
+            try:
+                call.result = function(*args)
+            except Exception as error:
+                call.error = error
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    ## Counters for tuning, resets them
+    def report(self):
+        with self.lock:
+            counters = {'executed' : self.executed, 'coalesced' : self.coalesced, 'max_waiters' : self.max_waiters, 'in_flight' : len(self.calls)}
+            self.executed = self.coalesced = self.max_waiters = 0
+        return counters
@@ -17,12 +17,19 @@ import ast
 import cherrypy
 import os
 import sys
+import itertools
 import numpy as np
 from datetime import datetime, timedelta
 from cherrypy.process.plugins import Monitor
 from cherrypy import tools
 from pymongo import MongoClient
 from bson import json_util
+from bson.objectid import ObjectId
+import buckets
+import catalog
+import assets
+import stats
+import coalesce
 
 # import zmq
 # from sklearn import svm
@@ -63,15 +70,26 @@ class HiveAggregator:
             self.SAMPLES_FILE = "samples.json"
             self.CSV_FILE = "samples.csv"
             self.ALL_PARAMETERS = ["time","int_t","ext_t","int_h","ext_h","hz","db","volts","amps","pa"]
+            self.STORAGE_LAYOUT = "sample" # 'sample' (one document per reading) or 'bucket' (see buckets.py)
+            self.BUCKET_SECONDS = 3600
+            self.CATALOG_DB = "catalog" # partition catalog (see catalog.py)
+            self.ASSET_MAX_AGE = 3600 # seconds browsers may reuse static assets before revalidating
+            self.GRAPH_PAGE_SIZE = 10000 # most samples returned by one graph request
             self.HIVE_COUNT = 4 # number of hives in database (would be better to determine this dynamically, w/o hardcoding)
         else:
             self.load_config(config_path)
         
+        # Concurrent identical queries share one in-flight Mongo query (see coalesce.py)
+        self.flights = coalesce.SingleFlight()
+        
         # Initializers
         # self.init_zmq()
         self.init_tasks()
         self.init_mongo()
+        self.init_assets()
         # self.init_sklearn()
+        if not hasattr(self, 'assets'): # the server cannot start without them
+            raise RuntimeError('static assets failed to load: %s' % getattr(self, 'assets_error', 'unknown error'))
     
     ## Load Configuration
     def load_config(self, config_path):
@@ -107,14 +125,38 @@ class HiveAggregator:
         except Exception as error:
             pretty_print('ERROR', str(error))
     
+    ## Initialize Static Assets
+    def init_assets(self):
+        pretty_print('CHERRYPY', 'Loading Static Assets')
+        try:
+            currdir = os.path.dirname(os.path.abspath(__file__))
+            self.assets = assets.AssetCache([('/', os.path.join(currdir, 'static'), None), ('/Static2', os.path.join(currdir, 'Static2'), assets.STATIC2_INCLUDE)], self.ASSET_MAX_AGE)
+            pretty_print('CHERRYPY', '%d assets, %d bytes in memory' % (len(self.assets.assets), self.assets.size()))
+        except Exception as error:
+            self.assets_error = error
+            pretty_print('ERROR', str(error))
+    
     ## Initialize MongoDB
     def init_mongo(self):
         pretty_print('MONGO', 'Initializing Mongo')
+        self.bucket_indexes = set() # (db_name, hive_id) pairs with the bucket index ensured
         try:
             self.mongo_client = MongoClient(self.MONGO_ADDR, self.MONGO_PORT)
+            self.mongo_client['test'].pilot2.ensure_index([('time', 1), ('_id', 1)]) # serves the graph query's (time, _id) keyset ordering
+            if self.STORAGE_LAYOUT == 'bucket':
+                db_name = datetime.strftime(datetime.now(), self.MONGO_DB)
+                for name in self.mongo_client[db_name].collection_names():
+                    if not name.startswith('system.'):
+                        self.ensure_bucket_index(db_name, name)
         except Exception as error:
             pretty_print('ERROR', str(error))
     
+    ## Ensure the bucket index, once per day-database and hive collection
+    def ensure_bucket_index(self, db_name, hive_id):
+        if (db_name, hive_id) not in self.bucket_indexes:
+            self.mongo_client[db_name][hive_id].ensure_index(buckets.INDEX)
+            self.bucket_indexes.add((db_name, hive_id))
+    
     """
     ## Initialize SKlearn
     def init_sklearn(self):     
@@ -146,18 +188,70 @@ class HiveAggregator:
     """
     
     ## Query Samples between start and end dates, dump to json
-    def query(self, start, end):
+    def query(self, start, end, fields=None, hives=None, after=None, limit=None):
+        """
+        Returns (json_data, next_cursor). fields limits the parameters returned,
+        hives the hive numbers queried. Results are ordered by (time, _id). Only
+        when limit or after is given are they paged, capped at limit (at most
+        GRAPH_PAGE_SIZE) samples; next_cursor is then the 'time|_id' of the last
+        sample when more remain, else None, and is passed back as after to
+        fetch the next page. Without either the whole range is returned.
+        """
         pretty_print('MONGO', "Querying samples bettween '{0}' and '{1}'".format(start, end))
         mongo_db = self.mongo_client['test'] # 'test' and 'pilot' (below) hardcoded temp variables for the db name and collection, respectively, that contain the pilot test data. Only applys to Natty's DB.
-        response = {}
-        i = 1
-        while i <= self.HIVE_COUNT:
-            key = "hive" + str(i) # create key
-            value = mongo_db.pilot2.find({'time': {"$gte": str(start), "$lte": str(end)}, 'hive_id': i}, { "DHT11_t":0, "DHT11_h":0 })  # query collection to find all documents within date-range. exclude DHT11 sensors. find() returns a cursor to the documents that match the query 
-            response[key] = value # append it to list
-            i += 1
+        if hives is None:
+            hives = range(1, self.HIVE_COUNT + 1)
+        if fields is None:
+            projection = { "DHT11_t":0, "DHT11_h":0 } # exclude DHT11 sensors
+        else:
+            projection = dict((key, 1) for key in ['time', 'hive_id'] + list(fields))
+        paged = limit is not None or after is not None # unpaged clients (front_end_scripts.js) get the whole range
+        limit = min(limit or self.GRAPH_PAGE_SIZE, self.GRAPH_PAGE_SIZE)
+        spec = {'time': {"$gte": str(start), "$lte": str(end)}, 'hive_id': {"$in": list(hives)}}
+        if after: # keyset pagination, resume after the last (time, _id) returned
+            after_time, after_id = after.rsplit('|', 1)
+            spec = {'$and': [spec, {'$or': [{'time': {"$gt": after_time}}, {'time': after_time, '_id': {"$gt": ObjectId(after_id)}}]}]}
+        cursor = mongo_db.pilot2.find(spec, projection).sort([('time', 1), ('_id', 1)])
+        samples = list(cursor.limit(limit + 1) if paged else cursor)
+        next_cursor = None
+        if paged and len(samples) > limit:
+            samples = samples[:limit]
+            next_cursor = '%s|%s' % (samples[-1]['time'], samples[-1]['_id'])
+        response = dict(("hive" + str(i), []) for i in hives) # create keys
+        for sample in samples:
+            response["hive" + str(sample['hive_id'])].append(sample)
         json_data = json_util.dumps(response) # dump query result to json
-        return json_data
+        return json_data, next_cursor
+    
+    ## Query Samples and encode the response body, returns (body, next_cursor)
+    def encode_graph(self, start, end, fields=None, hives=None, after=None, limit=None):
+        json_data, next_cursor = self.query(start, end, fields, hives, after, limit)
+        return json.dumps(json_data), next_cursor
+
+    ## Query per-bucket statistics between start and end dates
+    def query_stats(self, start, end, width, hives, parameters, percentiles):
+        pretty_print('MONGO', "Querying statistics bettween '{0}' and '{1}'".format(start, end))
+        start = datetime.strptime(start, self.TIME_FORMAT)
+        end = datetime.strptime(end, self.TIME_FORMAT)
+        days = (end.date() - start.date()).days + 1
+        db_names = [datetime.strftime(start + timedelta(days = d), self.MONGO_DB) for d in range(days)]
+        projection = dict((key, 1) for key in ['time', 'hive_id'] + parameters) # only the requested columns are read
+        summaries = {}
+        for partition in catalog.partitions(self.mongo_client, self.CATALOG_DB, db_names, start, end, hives, parameters):
+            collection = self.mongo_client[partition['db']][partition['hive_id']]
+            hive = summaries.setdefault(partition['hive_id'], dict((key, stats.Summary(width, bool(percentiles))) for key in parameters))
+            samples = collection.find({'type':buckets.SAMPLE_TYPE, 'time':{'$gte':start, '$lte':end}}, projection)
+            matches = buckets.unpack_buckets(collection.find(buckets.bucket_spec(start, end, self.BUCKET_SECONDS), projection), start, end, parameters)
+            times, values = stats.read_columns(itertools.chain(samples, matches), parameters) # this partition only, reduced below
+            for key in parameters:
+                hive[key].add(times, values[key])
+        response = {}
+        for hive_id, hive in summaries.items():
+            response[hive_id] = dict((key, summary.rows(percentiles)) for key, summary in hive.items())
+            for rows in response[hive_id].values():
+                for row in rows:
+                    row['start'] = datetime.strftime(row['start'], self.TIME_FORMAT)
+        return json.dumps(response)
     
     """
     ## Dump tp JSON
@@ -199,14 +293,25 @@ class HiveAggregator:
         pretty_print('MONGO', 'Storing Sample')
         try:
             sample['time'] = datetime.now()
-            db_name = datetime.strftime(datetime.now(), self.MONGO_DB) # this is the mongo db it saves to
+            db_name = datetime.strftime(sample['time'], self.MONGO_DB) # this is the mongo db it saves to
             mongo_db = self.mongo_client[db_name]
             hive = mongo_db[sample['hive_id']]
-            sample_id = hive.insert(sample)
+            if self.STORAGE_LAYOUT == 'bucket' and sample.get('type') == buckets.SAMPLE_TYPE: # logs and other messages stay plain documents
+                spec, document = buckets.bucket_update(sample, self.ALL_PARAMETERS, self.BUCKET_SECONDS)
+                self.ensure_bucket_index(db_name, sample['hive_id'])
+                bucket = hive.find_and_modify(spec, document, upsert=True, new=True, fields={'_id':1})
+                sample_id = bucket['_id']
+            else:
+                sample_id = hive.insert(sample)
             pretty_print('MONGO', 'Sample ID: %s' % str(sample_id))
-            return str(sample_id)
         except Exception as error:
             pretty_print('ERROR', str(error))
+            return None
+        try:
+            catalog.record(self.mongo_client, self.CATALOG_DB, db_name, sample, self.ALL_PARAMETERS)
+        except Exception as error:
+            pretty_print('ERROR', 'Catalog not updated (run scripts/rebuild_catalog.py): %s' % str(error)) # the sample is stored, so still report it
+        return str(sample_id)
     
     """                    
     ## Store Log
@@ -260,6 +365,8 @@ class HiveAggregator:
     ## Check Database
     def check(self):
         pretty_print('CHERRYPY', 'Checking database')
+        counters = self.flights.report()
+        pretty_print('CHERRYPY', 'Queries executed: %(executed)d, coalesced: %(coalesced)d, max waiters: %(max_waiters)d, in flight: %(in_flight)d' % counters)
     
     """
     Handler Functions
@@ -267,8 +374,7 @@ class HiveAggregator:
     ## Render Index
     @cherrypy.expose
     def index(self):
-        html = open('static/index.html').read()
-        return html
+        return self.assets.respond('/index.html')
     
     ## Handle Posts
     """
@@ -297,20 +403,73 @@ class HiveAggregator:
     @cherrypy.expose
     def graph(self, *args, **kwargs):
         try:
-            json_data = self.query(kwargs['start'], kwargs['end']) # TODO: set up logic so that query can be more precise/limit fields returned (?)
+            start, end = kwargs['start'].strip(), kwargs['end'].strip()
+            fields = [f for f in kwargs.get('fields', '').split(',') if f] or None # e.g. fields=int_t,ext_t
+            hives = self.parse_hives(kwargs.get('hives', '')) # e.g. hives=1,3 or hives=hive1,hive3
+            for key in fields or []:
+                if key not in self.ALL_PARAMETERS:
+                    raise ValueError('unknown field: %s' % key)
+            after = kwargs.get('after') or None
+            limit = int(kwargs['limit']) if kwargs.get('limit') else None
+            if limit is not None and limit < 1:
+                raise ValueError('limit must be a positive number of samples')
+            key = ('graph', start, end, tuple(sorted(fields or [])), tuple(sorted(hives or [])), after, limit)
+            body, next_cursor = self.flights.do(key, self.encode_graph, start, end, fields, hives, after, limit) # waiters share the encoded body
             cherrypy.response.headers['Content-Type'] = "application/json"
-            return json.dumps(json_data)
+            if next_cursor:
+                cherrypy.response.headers['X-Next-Cursor'] = next_cursor # pass back as after= for the next page
+            return body
         except Exception as err:
             pretty_print('ERROR', str(err))
-            
+
+    ## Hive numbers from a hives= parameter, which accepts 1,3 or hive1,hive3
+    def parse_hives(self, value):
+        return [int(h.strip().replace('hive', '')) for h in value.split(',') if h.strip()] or None
+
+    ## Handle per-bucket statistics, e.g.
+    ## stats?start=2015-06-01 00:00:00&end=2015-07-01 00:00:00&bucket=86400&hives=1,2&parameters=int_t&percentiles=50,90
+    @cherrypy.expose
+    def stats(self, *args, **kwargs):
+        try:
+            width = int(kwargs.get('bucket', 3600)) # seconds
+            hives = self.parse_hives(kwargs.get('hives', '')) # e.g. hives=1,3 or hives=hive1,hive3
+            hives = ['hive%d' % h for h in hives] if hives else None
+            parameters = [p for p in kwargs.get('parameters', '').split(',') if p] or [p for p in self.ALL_PARAMETERS if p != 'time']
+            percentiles = [float(p) for p in kwargs.get('percentiles', '').split(',') if p]
+            for key in parameters:
+                if key == 'time' or key not in self.ALL_PARAMETERS:
+                    raise ValueError('unknown parameter: %s' % key)
+            if width <= 0:
+                raise ValueError('bucket must be a positive number of seconds')
+            key = ('stats', kwargs['start'].strip(), kwargs['end'].strip(), width, tuple(sorted(hives or [])), tuple(sorted(parameters)), tuple(sorted(percentiles)))
+            json_data = self.flights.do(key, self.query_stats, key[1], key[2], width, hives, parameters, percentiles)
+            cherrypy.response.headers['Content-Type'] = "application/json"
+            return json_data
+        except Exception as err:
+            pretty_print('ERROR', str(err))
+
+    ## Handle hive listing and date coverage (served from the partition catalog)
+    @cherrypy.expose
+    def hives(self, *args, **kwargs):
+        try:
+            coverage = catalog.coverage(self.mongo_client, self.CATALOG_DB)
+            for hive in coverage.values():
+                hive['first'] = datetime.strftime(hive['first'], self.TIME_FORMAT)
+                hive['last'] = datetime.strftime(hive['last'], self.TIME_FORMAT)
+            cherrypy.response.headers['Content-Type'] = "application/json"
+            return json.dumps(coverage)
+        except Exception as err:
+            pretty_print('ERROR', str(err))
+
 # Main
 if __name__ == '__main__':
     aggregator = HiveAggregator(CONFIG_FILE)
     cherrypy.server.socket_host = aggregator.CHERRYPY_ADDR
     cherrypy.server.socket_port = aggregator.CHERRYPY_PORT
     currdir = os.path.dirname(os.path.abspath(__file__))
+    cherrypy.tools.assets = cherrypy.Tool('before_handler', aggregator.assets.tool) # static/ and Static2/ served from memory
     conf = {
-        '/': {'tools.staticdir.on':True, 'tools.staticdir.dir':os.path.join(currdir,'static')},
-        '/data': {'tools.staticdir.on':True, 'tools.staticdir.dir':os.path.join(currdir,'data')}, # NEED the '/' before the folder name
+        '/': {'tools.assets.on':True},
+        '/data': {'tools.assets.on':False, 'tools.staticdir.on':True, 'tools.staticdir.dir':os.path.join(currdir,'data')}, # NEED the '/' before the folder name
     }
     cherrypy.quickstart(aggregator, '/', config=conf)
@@ -10,31 +10,51 @@ TODO:
 """
 
 # Libraries
+import time
+STARTUP = time.time()
 import json
 import ast
-import cherrypy
+import importlib
 import os
 import sys
-import numpy as np
+import threading
 from datetime import datetime, timedelta
+
+## Startup Profile
+STARTUP_TIMES = []
+def profiled(name, function, *args):
+    start = time.time()
+    try:
+        return function(*args)
+    finally:
+        STARTUP_TIMES.append((name, time.time() - start))
+
+# Libraries (zmq, pymongo and sklearn are imported by their initializers)
+cherrypy = profiled('import cherrypy', importlib.import_module, 'cherrypy')
 from cherrypy.process.plugins import Monitor
 from cherrypy import tools
-from pymongo import MongoClient
-from bson import json_util
-import zmq
-from sklearn import svm
+buckets = profiled('import buckets', importlib.import_module, 'buckets')
+catalog = profiled('import catalog', importlib.import_module, 'catalog')
+assets = profiled('import assets', importlib.import_module, 'assets')
 
 # Constants
 try:
-    CONFIG_FILE = sys.argv[1]
+    CONFIG_FILE = [arg for arg in sys.argv[1:] if not arg.startswith('--')][0]
 except Exception as err:
     CONFIG_FILE = None
+PROFILE_STARTUP = '--profile-startup' in sys.argv
 
 ## Pretty Print
 def pretty_print(task, msg):
     date = datetime.strftime(datetime.now(), '%d/%b/%Y:%H:%M:%S')
     print('[%s] %s %s' % (date, task, msg))
 
+## Print Startup Profile
+def report_startup():
+    for name, seconds in STARTUP_TIMES:
+        pretty_print('PROFILE', '%-20s %8.3fs' % (name, seconds))
+    pretty_print('PROFILE', '%-20s %8.3fs' % ('total (wall)', time.time() - STARTUP))
+
 # HiveAggregator CherryPy server
 class HiveAggregator:
     
@@ -60,19 +80,29 @@ class HiveAggregator:
             self.SAMPLES_FILE = "samples.json"
             self.CSV_FILE = "samples.csv"
             self.ALL_PARAMETERS = ["time","int_t","ext_t","int_h","ext_h","hz","db","volts","amps","pa"]
+            self.STORAGE_LAYOUT = "sample" # 'sample' (one document per reading) or 'bucket' (see buckets.py)
+            self.BUCKET_SECONDS = 3600
+            self.CATALOG_DB = "catalog" # partition catalog (see catalog.py)
+            self.ASSET_MAX_AGE = 3600 # seconds browsers may reuse static assets before revalidating
         else:
             self.load_config(config_path)
         
-        # Initializers
-        self.init_zmq()
-        self.init_tasks()
-        self.init_mongo()
-        self.init_sklearn()
+        # Initializers (run in parallel; SKlearn is deferred until a learner is first used)
+        self.sklearn_lock = threading.Lock()
+        self.sklearn_ready = False
+        threads = [threading.Thread(target=profiled, args=(init.__name__, init)) for init in (self.init_zmq, self.init_mongo, self.init_assets)]
+        for thread in threads:
+            thread.start()
+        profiled('init_tasks', self.init_tasks)
+        for thread in threads:
+            thread.join()
+        if not hasattr(self, 'assets'): # the server cannot start without them
+            raise RuntimeError('static assets failed to load: %s' % getattr(self, 'assets_error', 'unknown error'))
     
     ## Load Configuration
     def load_config(self, config_path):
         pretty_print('CONFIG', 'Loading Config File')
-        with open(config_file) as config:
+        with open(config_path) as config:
             settings = json.loads(config.read())
             for key in settings:
                 try:
@@ -85,6 +115,7 @@ class HiveAggregator:
     def init_zmq(self):      
         pretty_print('ZMQ', 'Initializing ZMQ')
         try:
+            zmq = profiled('import zmq', importlib.import_module, 'zmq')
             self.context = zmq.Context()
             self.socket = self.context.socket(zmq.REP)
             self.socket.bind(self.ZMQ_SERVER)
@@ -101,43 +132,79 @@ class HiveAggregator:
         except Exception as error:
             pretty_print('ERROR', str(error))
     
+    ## Initialize Static Assets
+    def init_assets(self):
+        pretty_print('CHERRYPY', 'Loading Static Assets')
+        try:
+            currdir = os.path.dirname(os.path.abspath(__file__))
+            self.assets = assets.AssetCache([('/', os.path.join(currdir, 'static'), None), ('/Static2', os.path.join(currdir, 'Static2'), assets.STATIC2_INCLUDE)], self.ASSET_MAX_AGE)
+            pretty_print('CHERRYPY', '%d assets, %d bytes in memory' % (len(self.assets.assets), self.assets.size()))
+        except Exception as error:
+            self.assets_error = error
+            pretty_print('ERROR', str(error))
+    
     ## Initialize MongoDB
     def init_mongo(self):
         pretty_print('MONGO', 'Initializing Mongo')
+        self.bucket_indexes = set() # (db_name, hive_id) pairs with the bucket index ensured
         try:
-            self.mongo_client = MongoClient(self.MONGO_ADDR, self.MONGO_PORT)
+            pymongo = profiled('import pymongo', importlib.import_module, 'pymongo')
+            self.mongo_client = pymongo.MongoClient(self.MONGO_ADDR, self.MONGO_PORT)
+            if self.STORAGE_LAYOUT == 'bucket':
+                db_name = datetime.strftime(datetime.now(), self.MONGO_DB)
+                for name in self.mongo_client[db_name].collection_names():
+                    if not name.startswith('system.'):
+                        self.ensure_bucket_index(db_name, name)
         except Exception as error:
             pretty_print('ERROR', str(error))
     
+    ## Ensure the bucket index, once per day-database and hive collection
+    def ensure_bucket_index(self, db_name, hive_id):
+        if (db_name, hive_id) not in self.bucket_indexes:
+            self.mongo_client[db_name][hive_id].ensure_index(buckets.INDEX)
+            self.bucket_indexes.add((db_name, hive_id))
+    
     ## Initialize SKlearn
     def init_sklearn(self):     
         pretty_print('SKLEARN', 'Initializing SKlearn')
         try:
+            svm = profiled('import sklearn.svm', importlib.import_module, 'sklearn.svm')
             ## Learning Estimators
             self.svc_health = svm.SVC(kernel='rbf')
             self.svc_environment = svm.SVC(kernel='rbf')
             self.svc_activity = svm.SVC(kernel='rbf')
         except Exception as error:
             pretty_print('ERROR', str(error))
+    
+    ## Get Learner, initializing SKlearn on first use
+    def learner(self, name):
+        with self.sklearn_lock:
+            if not self.sklearn_ready:
+                profiled('init_sklearn', self.init_sklearn)
+                self.sklearn_ready = True
+        return getattr(self, 'svc_' + name)
         
     ## Query Samples in Range to JSON-file
     def query_db(self, days, query_type):
         pretty_print('MONGO', 'Querying samples for last %s days' % str(days))
         result = []
-        for d in range(days):
-            date = datetime.now() - timedelta(days = d)
-            db_name = datetime.strftime(date, self.MONGO_DB)
-            mongo_db = self.mongo_client[db_name]
-            for name in mongo_db.collection_names():
-                if not name == 'system.indexes':
-                    matches = mongo_db[name].find({'type':query_type})
-                    for sample in matches:
-                        sample['time'] = datetime.strftime(sample['time'], self.TIME_FORMAT)
-                        result.append(sample)
+        db_names = [datetime.strftime(datetime.now() - timedelta(days = d), self.MONGO_DB) for d in range(days)]
+        for partition in catalog.partitions(self.mongo_client, self.CATALOG_DB, db_names=db_names): # skips empty and missing days
+            collection = self.mongo_client[partition['db']][partition['hive_id']]
+            matches = collection.find({'type':query_type})
+            for sample in matches:
+                sample['time'] = datetime.strftime(sample['time'], self.TIME_FORMAT)
+                result.append(sample)
+            if query_type == buckets.SAMPLE_TYPE: # bucketed samples are unpacked into the same shape
+                matches = collection.find({'type':buckets.BUCKET_TYPE})
+                for sample in buckets.unpack_buckets(matches):
+                    sample['time'] = datetime.strftime(sample['time'], self.TIME_FORMAT)
+                    result.append(sample)
         return result
     
     ## Dump tp JSON
     def dump_json(self, results, filename):
+        from bson import json_util
         with open(self.DATA_PATH + filename, 'w') as jsonfile:
             dump = json_util.dumps(results, indent=4)
             jsonfile.write(dump)
@@ -149,7 +216,7 @@ class HiveAggregator:
         try:
             with open(self.DATA_PATH + filename, 'w') as csvfile:
                 for sample in results:
-                    del sample['_id']
+                    sample.pop('_id', None)
                     a = [i for i in sample.values()]
                     a.append('\n')
                     out = ','.join(a)
@@ -173,14 +240,25 @@ class HiveAggregator:
         pretty_print('MONGO', 'Storing Sample')
         try:
             sample['time'] = datetime.now()
-            db_name = datetime.strftime(datetime.now(), self.MONGO_DB) # this is the mongo db it saves to
+            db_name = datetime.strftime(sample['time'], self.MONGO_DB) # this is the mongo db it saves to
             mongo_db = self.mongo_client[db_name]
             hive = mongo_db[sample['hive_id']]
-            sample_id = hive.insert(sample)
+            if self.STORAGE_LAYOUT == 'bucket' and sample.get('type') == buckets.SAMPLE_TYPE: # logs and other messages stay plain documents
+                spec, document = buckets.bucket_update(sample, self.ALL_PARAMETERS, self.BUCKET_SECONDS)
+                self.ensure_bucket_index(db_name, sample['hive_id'])
+                bucket = hive.find_and_modify(spec, document, upsert=True, new=True, fields={'_id':1})
+                sample_id = bucket['_id']
+            else:
+                sample_id = hive.insert(sample)
             pretty_print('MONGO', 'Sample ID: %s' % str(sample_id))
-            return str(sample_id)
         except Exception as error:
             pretty_print('ERROR', str(error))
+            return None
+        try:
+            catalog.record(self.mongo_client, self.CATALOG_DB, db_name, sample, self.ALL_PARAMETERS)
+        except Exception as error:
+            pretty_print('ERROR', 'Catalog not updated (run scripts/rebuild_catalog.py): %s' % str(error)) # the sample is stored, so still report it
+        return str(sample_id)
                         
     ## Store Log
     def store_log(self, log):
@@ -239,8 +317,7 @@ class HiveAggregator:
     ## Render Index
     @cherrypy.expose
     def index(self):
-        html = open('static/index.html').read()
-        return html
+        return self.assets.respond('/index.html')
     
     ## Handle Posts
     """
@@ -267,11 +344,14 @@ class HiveAggregator:
 # Main
 if __name__ == '__main__':
     aggregator = HiveAggregator(CONFIG_FILE)
+    if PROFILE_STARTUP:
+        report_startup()
     cherrypy.server.socket_host = aggregator.CHERRYPY_ADDR
     cherrypy.server.socket_port = aggregator.CHERRYPY_PORT
     currdir = os.path.dirname(os.path.abspath(__file__))
+    cherrypy.tools.assets = cherrypy.Tool('before_handler', aggregator.assets.tool) # static/ and Static2/ served from memory
     conf = {
-        '/': {'tools.staticdir.on':True, 'tools.staticdir.dir':os.path.join(currdir,'static')},
-        '/data': {'tools.staticdir.on':True, 'tools.staticdir.dir':os.path.join(currdir,'data')}, # NEED the '/' before the folder name
+        '/': {'tools.assets.on':True},
+        '/data': {'tools.assets.on':False, 'tools.staticdir.on':True, 'tools.staticdir.dir':os.path.join(currdir,'data')}, # NEED the '/' before the folder name
     }
     cherrypy.quickstart(aggregator, '/', config=conf)
@@ -1,28 +1,147 @@
+#!/usr/bin/env python
+"""
+Dump DB
+Streaming, resumable export of stored samples
+
+Usage:
+    python scripts/dump_db.py [settings.json] --start "2015-06-01 00:00:00" --end "2015-09-01 00:00:00"
+        [--format ndjson|csv] [--output data/samples.ndjson.gz] [--window 24] [--workers 4]
+
+Samples are exported in time-ordered windows of --window hours. The hive
+collections of each window (as listed by the partition catalog) are read in
+parallel and merged by time, so memory stays bounded by one window. Output
+ending in .gz is gzip-compressed on the fly, one gzip member per window.
+After every window the output is flushed and a checkpoint (<output>.checkpoint)
+records the next window and the output size; re-running the same command
+(with explicit --start and --end) after an interruption truncates any partial
+window and resumes from there.
+"""
+
+# Libraries
+import argparse
+import gzip
+import heapq
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from pymongo import MongoClient
+from bson import json_util
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import settings
+import buckets
+import catalog
 
 class Dump:
-    def _init__(self):
-        self.MONGO_ADDR = "127.0.0.1"
-        self.MONGO_PORT = 27017
-        self.MONGO_DB = "HiveAggregator"
+    def __init__(self, config_path=None):
+        settings.load(self, config_path)
         self.mongo_client = MongoClient(self.MONGO_ADDR, self.MONGO_PORT)
-        self.mongo_db = self.mongo_client[self.MONGO_DB]
-        
-    def query_samples(self, hours):
-        print('[Querying Samples in Range] %s' % datetime.strftime(datetime.now(), self.TIME_FORMAT))
-        print('\tRange: ' + str(hours))
-        time_range = datetime.now() - timedelta(hours = hours) # get datetime
-        with open(self.DATA_PATH + 'samples.json', 'w') as jsonfile:
-            result = []
-            for name in self.mongo_db.collection_names():
-                if not name == 'system.indexes':
-                    # Add filters here to only include average values
-                    for sample in self.mongo_db[name].find({'type':'sample', 'time':{'$gt': time_range, '$lt':datetime.now()}}):
-                        print sample
-                        sample['time'] = datetime.strftime(sample['time'], self.TIME_FORMAT)
-                        result.append(sample)
-            dump = json_util.dumps(result, indent=4)
-            jsonfile.write(dump)
+
+    ## Samples of one partition within [start, end), sorted by time
+    def query_partition(self, partition, start, end):
+        collection = self.mongo_client[partition['db']][partition['hive_id']]
+        result = list(collection.find({'type':buckets.SAMPLE_TYPE, 'time':{'$gte':start, '$lt':end}}))
+        spec = buckets.bucket_spec(start, end, self.BUCKET_SECONDS)
+        result.extend(s for s in buckets.unpack_buckets(collection.find(spec), start) if s['time'] < end)
+        result.sort(key=lambda s: s['time']) # sorted here, day collections have no time index for a server-side sort
+        return result
+
+    ## Samples of every partition within [start, end), merged by time
+    def query_window(self, pool, start, end):
+        days = (end - start).days + 2
+        db_names = [datetime.strftime(start + timedelta(days=d), self.MONGO_DB) for d in range(days)]
+        partitions = catalog.partitions(self.mongo_client, self.CATALOG_DB, db_names=db_names, start=start, end=end)
+        results = pool.map(lambda p: self.query_partition(p, start, end), partitions)
+        streams = [[(s['time'], i, j, s) for j, s in enumerate(result)] for i, result in enumerate(results)]
+        for sample_time, i, j, sample in heapq.merge(*streams):
+            yield sample
+
+    ## Encode one sample
+    def encode(self, sample, file_format):
+        sample['time'] = datetime.strftime(sample['time'], self.TIME_FORMAT)
+        if file_format == 'csv':
+            values = [sample.get(key) for key in ['hive_id'] + self.ALL_PARAMETERS]
+            return ','.join('' if v is None else str(v) for v in values) + '\n'
+        return json_util.dumps(sample) + '\n'
+
+    ## Load the checkpoint if it belongs to the same export
+    def load_checkpoint(self, path, job):
+        try:
+            with open(path) as checkpoint_file:
+                checkpoint = json.loads(checkpoint_file.read())
+        except (IOError, ValueError):
+            return None
+        if checkpoint.get('job') != job:
+            return None
+        return checkpoint
+
+    ## Write the checkpoint atomically
+    def save_checkpoint(self, path, checkpoint):
+        with open(path + '.tmp', 'w') as checkpoint_file:
+            checkpoint_file.write(json.dumps(checkpoint))
+        os.rename(path + '.tmp', path)
+
+    def export(self, start, end, output, file_format='ndjson', window_hours=24, workers=4):
+        checkpoint_path = output + '.checkpoint'
+        job = {'start':start, 'end':end, 'format':file_format, 'window':window_hours}
+        checkpoint = self.load_checkpoint(checkpoint_path, job)
+        if checkpoint and (not os.path.exists(output) or os.path.getsize(output) < checkpoint['offset']):
+            print('[Discarding Checkpoint] %s is missing or shorter than checkpointed, starting over' % output)
+            checkpoint = None
+        if checkpoint:
+            print('[Resuming Export] %s at %s' % (output, checkpoint['next']))
+            raw = open(output, 'r+b')
+            raw.truncate(checkpoint['offset']) # drop any partial window
+            raw.seek(checkpoint['offset'])
+        else:
+            checkpoint = {'job':job, 'next':start, 'offset':0, 'rows':0}
+            raw = open(output, 'wb')
+        compress = output.endswith('.gz')
+        window = timedelta(hours=window_hours)
+        window_start = datetime.strptime(checkpoint['next'], self.TIME_FORMAT)
+        end_time = datetime.strptime(end, self.TIME_FORMAT)
+        pool = ThreadPool(workers)
+        try:
+            while window_start < end_time:
+                window_end = min(window_start + window, end_time)
+                started = time.time()
+                out = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) if compress else raw
+                if checkpoint['offset'] == 0 and file_format == 'csv':
+                    out.write((','.join(['hive_id'] + self.ALL_PARAMETERS) + '\n').encode('utf-8'))
+                rows = 0
+                for sample in self.query_window(pool, window_start, window_end):
+                    out.write(self.encode(sample, file_format).encode('utf-8'))
+                    rows += 1
+                if compress:
+                    out.close() # completes the gzip member, leaves raw open
+                raw.flush()
+                os.fsync(raw.fileno())
+                checkpoint['next'] = datetime.strftime(window_end, self.TIME_FORMAT)
+                checkpoint['offset'] = raw.tell()
+                checkpoint['rows'] += rows
+                self.save_checkpoint(checkpoint_path, checkpoint)
+                print('[%s - %s] %d samples (%.1fs), %d total' % (datetime.strftime(window_start, self.TIME_FORMAT), checkpoint['next'], rows, time.time() - started, checkpoint['rows']))
+                window_start = window_end
+        finally:
+            pool.close()
+            raw.close()
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        print('[Export Complete] %s: %d samples' % (output, checkpoint['rows']))
 
 if __name__ == '__main__':
-    root = Dump()
-    root.query_samples(168)
+    parser = argparse.ArgumentParser(description='Export stored samples as NDJSON or CSV')
+    parser.add_argument('config', nargs='?', default=None, help='settings file (optional)')
+    parser.add_argument('--start', default=datetime.strftime(datetime.now() - timedelta(hours=168), "%Y-%m-%d %H:%M:%S"))
+    parser.add_argument('--end', default=datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S"))
+    parser.add_argument('--format', default='ndjson', choices=['ndjson', 'csv'])
+    parser.add_argument('--output', default=None, help='default data/samples.<format>.gz')
+    parser.add_argument('--window', type=int, default=24, help='hours per window')
+    parser.add_argument('--workers', type=int, default=4, help='collections read in parallel')
+    args = parser.parse_args()
+    root = Dump(args.config)
+    output = args.output or 'data/samples.%s.gz' % args.format
+    root.export(args.start, args.end, output, args.format, args.window, args.workers)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Import CSV
+Parallel bulk loader for historical per-hive CSV sample files
+
+Usage:
+    python scripts/import_csv.py [settings.json] data/hive*.csv
+        [--hive hive4] [--columns time,int_t,ext_t] [--workers 4] [--chunk-mb 16]
+
+Each file is memory-mapped and split into newline-aligned chunks which a
+process pool parses into columns. Columns are mapped onto ALL_PARAMETERS
+(unknown columns are ignored) and written into the same "%Y%m%d"
+day-databases and hive collections as store_sample(), with large unordered
+(continue_on_error) inserts, or $push upserts when STORAGE_LAYOUT is
+'bucket'. The partition catalog is updated as each chunk is stored, so an
+interrupted import leaves no uncatalogued rows. Rows without a parseable
+time (or hive_id, when the file has that column) are skipped and counted.
+
+The hive is taken from a hive_id column, else --hive, else a 'hive<N>' in
+the file name. A header row is used when present, else --columns, else
+ALL_PARAMETERS in order.
+"""
+
+# Libraries
+import argparse
+import csv
+import mmap
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from multiprocessing import Pool
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import settings
+import buckets
+import catalog
+
+# Constants
+INSERT_BATCH = 5000
+
+## Worker state, one Mongo connection per process
+WORKER = {}
+def init_worker(config):
+    WORKER['config'] = config
+    WORKER['mongo_client'] = MongoClient(config['MONGO_ADDR'], config['MONGO_PORT'])
+
+## Parse a numeric field, None if empty or not a number
+def parse_value(field):
+    try:
+        return float(field)
+    except ValueError:
+        return None
+
+## Parse one chunk of a file into columns
+def parse_chunk(path, start, end, columns, hive_id, time_format):
+    """
+    Returns (result, skipped): a dict of equal-length lists keyed by 'time',
+    'hive_id' and each mapped parameter, and the number of non-blank rows
+    dropped. columns maps a field index to its parameter name.
+    """
+    with open(path, 'rb') as csv_file:
+        data = mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            text = data[start:end].decode('utf-8')
+        finally:
+            data.close()
+    result = dict((name, []) for name in columns.values())
+    result['hive_id'] = []
+    time_index = [i for i, name in columns.items() if name == 'time'][0]
+    hive_index = [i for i, name in columns.items() if name == 'hive_id']
+    items = [(i, name) for i, name in columns.items() if name not in ('time', 'hive_id')]
+    skipped = 0
+    for fields in csv.reader(text.splitlines()):
+        if not fields or not any(field.strip() for field in fields):
+            continue # blank line
+        if len(fields) <= time_index or (hive_index and (len(fields) <= hive_index[0] or not fields[hive_index[0]].strip())):
+            skipped += 1
+            continue
+        try:
+            sample_time = datetime.strptime(fields[time_index].strip(), time_format)
+        except ValueError:
+            skipped += 1
+            continue
+        result['time'].append(sample_time)
+        result['hive_id'].append(fields[hive_index[0]].strip() if hive_index else hive_id)
+        for i, name in items:
+            result[name].append(parse_value(fields[i]) if i < len(fields) else None)
+    return result, skipped
+
+## Parse and store one chunk
+def load_chunk(task):
+    """
+    Returns (rows, skipped, bytes, summary, updates). summary maps (db_name, hive_id)
+    to [min_time, max_time, count, present parameters]. In the bucket layout
+    the bucket upserts are returned in updates for the parent to apply, so
+    no two processes upsert the same bucket at once.
+    """
+    config = WORKER['config']
+    mongo_client = WORKER['mongo_client']
+    columns, skipped = parse_chunk(*task)
+    parameters = [key for key in config['ALL_PARAMETERS'] if key in columns]
+    partitions = {}
+    for i, sample_time in enumerate(columns['time']):
+        sample = {'type' : buckets.SAMPLE_TYPE, 'hive_id' : columns['hive_id'][i], 'time' : sample_time}
+        for key in parameters:
+            if key != 'time' and columns[key][i] is not None:
+                sample[key] = columns[key][i]
+        db_name = datetime.strftime(sample_time, config['MONGO_DB'])
+        partitions.setdefault((db_name, sample['hive_id']), []).append(sample)
+    summary = {}
+    updates = []
+    for (db_name, hive_id), samples in partitions.items():
+        collection = mongo_client[db_name][hive_id]
+        if config['STORAGE_LAYOUT'] == 'bucket':
+            groups = buckets.group_samples(samples, config['BUCKET_SECONDS'])
+            for key in sorted(groups):
+                spec, document = buckets.bucket_update_many(groups[key], config['ALL_PARAMETERS'], config['BUCKET_SECONDS']) # None for absent columns keeps the arrays aligned
+                updates.append((db_name, hive_id, spec, document))
+        else:
+            for i in range(0, len(samples), INSERT_BATCH):
+                collection.insert(samples[i:i + INSERT_BATCH], continue_on_error=True, manipulate=False)
+        times = [sample['time'] for sample in samples]
+        present = set(key for sample in samples for key in sample if key in parameters)
+        summary[(db_name, hive_id)] = [min(times), max(times), len(times), present]
+    return len(columns['time']), skipped, task[2] - task[1], summary, updates
+
+class ImportCSV:
+    def __init__(self, config_path=None):
+        settings.load(self, config_path)
+
+    ## Map header names (or --columns) to parameter names by field index
+    def map_columns(self, names):
+        columns = {}
+        for i, name in enumerate(names):
+            name = name.strip().lower()
+            if name in self.ALL_PARAMETERS or name == 'hive_id':
+                columns[i] = name
+        if 'time' not in columns.values():
+            raise ValueError('no time column in %s' % ','.join(names))
+        return columns
+
+    ## Newline-aligned (start, end) byte ranges of a file, and the column mapping
+    def plan_file(self, path, chunk_bytes, column_names):
+        with open(path, 'rb') as csv_file:
+            size = os.fstat(csv_file.fileno()).st_size
+            if size == 0:
+                return [], None
+            data = mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                first_end = data.find(b'\n')
+                first_end = size if first_end < 0 else first_end + 1
+                first = next(csv.reader([data[:first_end].decode('utf-8').strip()]), [])
+                if any(name.strip().lower() in self.ALL_PARAMETERS + ['hive_id'] for name in first):
+                    start = first_end # header row
+                    names = first
+                else:
+                    start = 0
+                    names = column_names or self.ALL_PARAMETERS
+                ranges = []
+                while start < size:
+                    end = data.find(b'\n', min(start + chunk_bytes, size - 1))
+                    end = size if end < 0 else end + 1
+                    ranges.append((start, end))
+                    start = end
+            finally:
+                data.close()
+        return ranges, self.map_columns(names)
+
+    def load(self, paths, hive=None, column_names=None, workers=4, chunk_mb=16):
+        config = dict((key, getattr(self, key)) for key in ['MONGO_ADDR', 'MONGO_PORT', 'MONGO_DB', 'STORAGE_LAYOUT', 'BUCKET_SECONDS', 'ALL_PARAMETERS'])
+        tasks = []
+        for path in paths:
+            ranges, columns = self.plan_file(path, chunk_mb * 1024 * 1024, column_names)
+            if not ranges:
+                continue
+            hive_id = hive
+            if hive_id is None and 'hive_id' not in columns.values():
+                match = re.search(r'hive\d+', os.path.basename(path))
+                if not match:
+                    raise ValueError('no hive_id column, --hive or hive<N> file name for %s' % path)
+                hive_id = match.group(0)
+            tasks.extend((path, start, end, columns, hive_id, self.TIME_FORMAT) for start, end in ranges)
+        total_bytes = sum(task[2] - task[1] for task in tasks)
+        done_bytes = rows = skipped = 0
+        partitions = set()
+        started = time.time()
+        mongo_client = MongoClient(self.MONGO_ADDR, self.MONGO_PORT)
+        pool = Pool(workers, init_worker, (config,))
+        try:
+            for count, chunk_skipped, chunk_bytes, summary, updates in pool.imap_unordered(load_chunk, tasks):
+                rows += count
+                skipped += chunk_skipped
+                done_bytes += chunk_bytes
+                for db_name, hive_id, spec, document in updates:
+                    mongo_client[db_name][hive_id].update(spec, document, upsert=True)
+                for (db_name, hive_id), (min_time, max_time, samples, present) in summary.items():
+                    catalog.record_many(mongo_client, self.CATALOG_DB, db_name, hive_id, [min_time, max_time], samples, present)
+                    partitions.add((db_name, hive_id))
+                elapsed = time.time() - started
+                print('[Import] %5.1f%% %d rows, %d skipped, %d rows/s' % (100.0 * done_bytes / max(total_bytes, 1), rows, skipped, rows / max(elapsed, 1e-6)))
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - started
+        print('[Import Complete] %d rows in %.1fs (%d rows/s), %d skipped, %d partitions' % (rows, elapsed, rows / max(elapsed, 1e-6), skipped, len(partitions)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk load historical CSV sample files')
+    parser.add_argument('files', nargs='+', help='CSV files, optionally preceded by a settings .json file')
+    parser.add_argument('--hive', default=None, help='hive_id for files without a hive_id column')
+    parser.add_argument('--columns', default=None, help='comma-separated column names for files without a header')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--chunk-mb', type=int, default=16)
+    args = parser.parse_args()
+    config = args.files[0] if args.files[0].endswith('.json') else None
+    root = ImportCSV(config)
+    column_names = args.columns.split(',') if args.columns else None
+    root.load([f for f in args.files if not f.endswith('.json')], args.hive, column_names, args.workers, args.chunk_mb)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Migrate Buckets
+Rewrites per-reading sample documents into the time-bucketed layout
+
+Usage:
+    python scripts/migrate_buckets.py [settings.json] [--keep]
+
+Every "%Y%m%d" day-database is scanned, each hive collection's samples are
+grouped into BUCKET_SECONDS buckets and written with $push upserts, then the
+original sample documents of each bucket are removed right after its upsert
+unless --keep is given. Without --keep re-running is safe: migrated samples
+no longer exist as readings, and an interruption can leave at most the one
+bucket being written pushed without its readings removed. With --keep a
+second run would push the same readings into the buckets again.
+"""
+
+# Libraries
+import os
+import sys
+from datetime import datetime
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import settings
+import buckets
+
+class MigrateBuckets:
+    def __init__(self, config_path=None):
+        settings.load(self, config_path)
+        self.mongo_client = MongoClient(self.MONGO_ADDR, self.MONGO_PORT)
+
+    ## Day-databases matching the MONGO_DB format
+    def day_databases(self):
+        for db_name in sorted(self.mongo_client.database_names()):
+            try:
+                datetime.strptime(db_name, self.MONGO_DB)
+            except ValueError:
+                continue
+            yield db_name
+
+    ## Migrate one hive collection
+    def migrate_collection(self, collection, keep):
+        samples = list(collection.find({'type':buckets.SAMPLE_TYPE}).sort('time', 1))
+        if not samples:
+            return 0
+        collection.ensure_index(buckets.INDEX)
+        groups = buckets.group_samples(samples, self.BUCKET_SECONDS)
+        for key in sorted(groups): # upsert and remove one bucket at a time, so an interruption leaves at most one partial bucket
+            spec, document = buckets.bucket_update_many(groups[key], self.ALL_PARAMETERS, self.BUCKET_SECONDS)
+            collection.update(spec, document, upsert=True)
+            if not keep:
+                collection.remove({'_id':{'$in':[s['_id'] for s in groups[key]]}})
+        return len(samples)
+
+    def migrate(self, keep=False):
+        for db_name in self.day_databases():
+            mongo_db = self.mongo_client[db_name]
+            for name in mongo_db.collection_names():
+                if not name == 'system.indexes':
+                    count = self.migrate_collection(mongo_db[name], keep)
+                    print('[%s/%s] %d samples migrated' % (db_name, name, count))
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    root = MigrateBuckets(args[0] if args else None)
+    root.migrate(keep='--keep' in sys.argv)
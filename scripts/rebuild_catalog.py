@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+"""
+Rebuild Catalog
+Recreates the partition catalog from the "%Y%m%d" day-databases
+
+Usage:
+    python scripts/rebuild_catalog.py [settings.json]
+
+The aggregator keeps the catalog current on ingest; this is only needed for
+data stored before the catalog existed or written by other tools. Stop the
+aggregator first, since samples stored during the scan are not counted.
+"""
+
+# Libraries
+import os
+import sys
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import settings
+import catalog
+
+class RebuildCatalog:
+    def __init__(self, config_path=None):
+        settings.load(self, config_path)
+        self.mongo_client = MongoClient(self.MONGO_ADDR, self.MONGO_PORT)
+
+    def rebuild(self):
+        for db_name, name, count in catalog.rebuild(self.mongo_client, self.CATALOG_DB, self.MONGO_DB, self.ALL_PARAMETERS):
+            print('[%s/%s] %d samples' % (db_name, name, count))
+
+if __name__ == '__main__':
+    root = RebuildCatalog(sys.argv[1] if len(sys.argv) > 1 else None)
+    root.rebuild()
@@ -0,0 +1,32 @@
+"""
+Settings
+Shared defaults and settings-file loading for the scripts/ tools
+
+The defaults match the HiveAggregator server's; a settings file such as
+configs/settings.json overrides them.
+"""
+
+# Libraries
+import json
+
+# Constants
+DEFAULTS = {
+    'MONGO_ADDR' : "127.0.0.1",
+    'MONGO_PORT' : 27017,
+    'MONGO_DB' : "%Y%m%d",
+    'CATALOG_DB' : "catalog",
+    'TIME_FORMAT' : "%Y-%m-%d %H:%M:%S",
+    'STORAGE_LAYOUT' : "sample",
+    'BUCKET_SECONDS' : 3600,
+    'ALL_PARAMETERS' : ["time","int_t","ext_t","int_h","ext_h","hz","db","volts","amps","pa"],
+    }
+
+## Set the defaults, then any settings from config_path, as attributes of obj
+def load(obj, config_path=None):
+    for key, value in DEFAULTS.items():
+        setattr(obj, key, list(value) if isinstance(value, list) else value)
+    if config_path:
+        with open(config_path) as config:
+            settings = json.loads(config.read())
+            for key in settings:
+                setattr(obj, key, settings[key])
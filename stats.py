@@ -0,0 +1,100 @@
+"""
+Stats
+Per-bucket summary statistics over sample columns
+
+Each partition (one day of one hive) is read into compact float arrays
+(epoch seconds plus one array per parameter, NaN where a reading is missing)
+and immediately reduced with NumPy to per-bucket count/min/max/sum. The
+partial results are merged per bucket across partitions, so only one small
+summary row per time bucket leaves the server. Raw values are kept, as one
+array per partition and bucket, only when percentiles are requested.
+"""
+
+# Libraries
+import numpy as np
+from array import array
+from datetime import datetime, timedelta
+
+# Constants
+EPOCH = datetime(1970, 1, 1)
+
+## Seconds since the epoch of a naive datetime
+def epoch_seconds(time):
+    return (time - EPOCH).total_seconds()
+
+## Read samples into a times array and one float array per parameter
+def read_columns(samples, parameters):
+    times = array('d')
+    values = dict((key, array('d')) for key in parameters)
+    for sample in samples:
+        times.append(epoch_seconds(sample['time']))
+        for key in parameters:
+            try:
+                values[key].append(float(sample.get(key)))
+            except (TypeError, ValueError):
+                values[key].append(np.nan)
+    return np.frombuffer(times, dtype=float), dict((key, np.frombuffer(column, dtype=float)) for key, column in values.items())
+
+## Per-bucket partial results for one column of one partition
+def reduce_column(times, values, width, keep_values=False):
+    """
+    times and values are equal-length arrays; width is the bucket width in
+    seconds. Yields (bucket key, count, min, max, sum, values) for each
+    non-empty bucket, where values is the bucket's readings if keep_values
+    and None otherwise.
+    """
+    keep = ~np.isnan(values)
+    times, values = times[keep], values[keep]
+    if not len(values):
+        return
+    keys = np.floor(times / width) * width
+    order = np.argsort(keys, kind='mergesort')
+    keys, values = keys[order], values[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(values)])
+    mins = np.minimum.reduceat(values, starts)
+    maxs = np.maximum.reduceat(values, starts)
+    sums = np.add.reduceat(values, starts)
+    for i, start in enumerate(starts):
+        group = values[start:start + counts[i]] if keep_values else None
+        yield float(keys[start]), int(counts[i]), float(mins[i]), float(maxs[i]), float(sums[i]), group
+
+## Per-bucket summary of one column, merged partition by partition
+class Summary:
+    def __init__(self, width, keep_values=False):
+        self.width = width
+        self.keep_values = keep_values
+        self.buckets = {} # bucket key -> [count, min, max, sum, [value arrays]]
+
+    def add(self, times, values):
+        for key, count, low, high, total, group in reduce_column(times, values, self.width, self.keep_values):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [0, low, high, 0.0, []]
+            bucket[0] += count
+            bucket[1] = min(bucket[1], low)
+            bucket[2] = max(bucket[2], high)
+            bucket[3] += total
+            if group is not None:
+                bucket[4].append(group)
+
+    def rows(self, percentiles):
+        """
+        Returns one dict per non-empty bucket, in time order, with start
+        (datetime), count, min, max, mean and p<N> for each percentile.
+        """
+        rows = []
+        for key in sorted(self.buckets):
+            count, low, high, total, groups = self.buckets[key]
+            row = {
+                'start' : EPOCH + timedelta(seconds=key),
+                'count' : count,
+                'min' : low,
+                'max' : high,
+                'mean' : total / count,
+                }
+            if percentiles and groups:
+                for p, value in zip(percentiles, np.percentile(np.concatenate(groups), percentiles)):
+                    row['p%g' % p] = float(value)
+            rows.append(row)
+        return rows